@@ -1,227 +1,608 @@
-import os
-import zipfile
-from io import BytesIO
-from datetime import datetime
-from typing import List
-import logging
-
-import paramiko
-from ftplib import FTP_TLS
-import posixpath
-from typing import Tuple
-
-logger = logging.getLogger(__name__)
-
-def download_from_server(host: str, username: str, password: str, directory: str,
-                         download_path: str, filename_startswith: List[str] = None,
-                         from_date: str = "", port: int = None, conn_type: str = "sftp") -> BytesIO:
-    filename_startswith = filename_startswith or []
-    os.makedirs(download_path, exist_ok=True)
-    seleccionados = []
-
-    logger.info("Starting download from %s (type: %s)", host, conn_type)
-
-    if conn_type.lower() == "ftps":
-        port = port or 990
-        ftps = FTP_TLS()
-        logger.info("Connecting to FTPS %s:%s", host, port)
-        ftps.connect(host, port, timeout=30)
-        ftps.auth()
-        ftps.login(username, password)
-        ftps.prot_p()
-        ftps.cwd(directory)
-        logger.info("Connected to FTPS, listing directory %s", directory)
-
-        archivos = ftps.nlst()
-        logger.info("Found %d files in directory", len(archivos))
-
-        def get_mod_time(f):
-            mdtm = ftps.sendcmd(f"MDTM {f}")
-            return datetime.strptime(mdtm[4:], "%Y%m%d%H%M%S")
-
-        def download_func(f, path):
-            with open(path, "wb") as file:
-                ftps.retrbinary(f"RETR {f}", file.write)
-
-        def close_func():
-            logger.info("Closing FTPS connection")
-            ftps.quit()
-
-    elif conn_type.lower() == "sftp":
-        port = port or 22
-        logger.info("Connecting to SFTP %s:%s", host, port)
-        transport = paramiko.Transport((host, port))
-        transport.connect(username=username, password=password)
-        client = paramiko.SFTPClient.from_transport(transport)
-        archivos = client.listdir(directory)
-        logger.info("Connected to SFTP, found %d files in directory", len(archivos))
-
-        def get_mod_time(f):
-            path = posixpath.join(directory, f)
-            attr = client.stat(path)
-            return datetime.fromtimestamp(attr.st_mtime)
-
-        download_func = lambda f, path: client.get(posixpath.join(directory, f), path)
-
-        def close_func():
-            logger.info("Closing SFTP connection")
-            client.close()
-            transport.close()
-
-    else:
-        raise ValueError("conn_type debe ser 'sftp' o 'ftps'")
-
-    # Filtrar archivos
-    logger.info("Filtering files (startswith: %s, from_date: %s)", filename_startswith, from_date)
-    for archivo in archivos:
-        if filename_startswith and not any(archivo.startswith(p) for p in filename_startswith):
-            continue
-        if from_date and get_mod_time(archivo) < datetime.fromisoformat(from_date):
-            continue
-        seleccionados.append(archivo)
-
-    logger.info("Selected %d files to download", len(seleccionados))
-
-    if not seleccionados:
-        logger.warning("No files found matching criteria")
-        close_func()
-        raise Exception("No se encontraron archivos con los criterios dados")
-
-    # Descargar archivos
-    logger.info("Starting file downloads")
-    for i, archivo in enumerate(seleccionados, 1):
-        logger.info("Downloading file %d/%d: %s", i, len(seleccionados), archivo)
-        local_path = os.path.join(download_path, archivo)
-        download_func(archivo, local_path)
-
-    logger.info("All files downloaded, closing connection")
-    close_func()
-
-    # Crear ZIP en memoria
-    logger.info("Creating ZIP archive")
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for archivo in seleccionados:
-            zipf.write(os.path.join(download_path, archivo), arcname=archivo)
-
-    zip_buffer.seek(0)
-    logger.info("Download complete, returning ZIP archive")
-    return zip_buffer
-
-
-def upload_to_server(host: str, username: str, password: str, remote_directory: str,
-                     files: List[Tuple[str, bytes]], port: int = None, conn_type: str = "sftp") -> List[str]:
-    """Upload a list of (relative_path, bytes_content) to the remote server under `remote_directory`.
-
-    Returns list of remote paths uploaded.
-    """
-    uploaded = []
-    # Ensure remote_directory is posix-style
-    remote_base = remote_directory or "."
-
-    if conn_type.lower() == "ftps":
-        port = port or 990
-        ftps = FTP_TLS()
-        ftps.connect(host, port, timeout=30)
-        ftps.auth()
-        ftps.login(username, password)
-        ftps.prot_p()
-
-        # Helper to create nested dirs on FTPS
-        def ensure_dir(path: str):
-            # change to base first
-            try:
-                ftps.cwd(remote_base)
-            except Exception:
-                # try to create base
-                try:
-                    ftps.mkd(remote_base)
-                    ftps.cwd(remote_base)
-                except Exception:
-                    pass
-            parts = [p for p in path.split("/") if p]
-            for p in parts:
-                try:
-                    ftps.cwd(p)
-                except Exception:
-                    try:
-                        ftps.mkd(p)
-                        ftps.cwd(p)
-                    except Exception:
-                        # if still failing, raise
-                        raise
-            # go back to root of base
-            ftps.cwd(remote_base)
-
-        for relpath, content in files:
-            # normalize to posix
-            relposix = posixpath.normpath(relpath).lstrip("/")
-            if relposix == "" or relposix.startswith(".."):
-                continue
-            remote_path = posixpath.join(remote_base, relposix)
-            remote_dir = posixpath.dirname(remote_path)
-            # Ensure remote_dir exists
-            if remote_dir and remote_dir != ".":
-                ensure_dir(remote_dir)
-
-            # storbinary expects a file-like object
-            from io import BytesIO
-            bio = BytesIO(content)
-            # Navigate to remote_dir then storbinary with filename
-            try:
-                ftps.cwd(remote_dir or remote_base)
-            except Exception:
-                # ensure and retry
-                ensure_dir(remote_dir)
-                ftps.cwd(remote_dir or remote_base)
-
-            with bio:
-                ftps.storbinary(f"STOR {posixpath.basename(remote_path)}", bio)
-
-            uploaded.append(remote_path)
-
-        ftps.quit()
-
-    elif conn_type.lower() == "sftp":
-        port = port or 22
-        transport = paramiko.Transport((host, port))
-        transport.connect(username=username, password=password)
-        client = paramiko.SFTPClient.from_transport(transport)
-
-        # ensure remote directory exists (posix)
-        def ensure_remote_dirs(path: str):
-            parts = [p for p in path.split("/") if p]
-            cur = ""
-            for p in parts:
-                cur = posixpath.join(cur, p) if cur else p
-                try:
-                    client.stat(cur)
-                except IOError:
-                    try:
-                        client.mkdir(cur)
-                    except Exception:
-                        # Could be created concurrently; ignore
-                        pass
-
-        for relpath, content in files:
-            relposix = posixpath.normpath(relpath).lstrip("/")
-            if relposix == "" or relposix.startswith(".."):
-                continue
-            remote_path = posixpath.join(remote_base, relposix)
-            remote_dir = posixpath.dirname(remote_path)
-            if remote_dir and remote_dir != ".":
-                ensure_remote_dirs(remote_dir)
-
-            # write bytes to remote file
-            with client.open(remote_path, "wb") as f:
-                f.write(content)
-
-            uploaded.append(remote_path)
-
-        client.close()
-        transport.close()
-
-    else:
-        raise ValueError("conn_type must be 'sftp' or 'ftps'")
-
-    return uploaded
+import hashlib
+import os
+import queue
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import BinaryIO, List
+import logging
+
+import paramiko
+import paramiko.sftp_file
+import re
+from ftplib import FTP_TLS, error_perm
+import posixpath
+from typing import Dict, Tuple
+
+try:
+    # isal implementa deflate vectorizado; como es API-compatible con zlib
+    # basta redirigir el módulo que usa zipfile. Si no está instalado seguimos
+    # con el zlib de la stdlib.
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib
+except ImportError:
+    isal_zlib = None
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.getenv("SFTP_POOL_SIZE", "8"))
+MAX_WORKERS = int(os.getenv("SFTP_MAX_WORKERS", str(POOL_SIZE)))
+# Ventana de prefetch acotada: sin límite algunos servidores OpenSSH (cap de 64
+# requests en vuelo) se cuelgan; bajarla alivia la contención cuando muchos
+# clientes comparten ancho de banda.
+PREFETCH_WINDOW = int(os.getenv("SFTP_PREFETCH_WINDOW", "64"))
+# Umbral a partir del cual los archivos en tránsito se derraman a disco
+# temporal en vez de quedarse en memoria.
+SPOOL_MAX_SIZE = int(os.getenv("SFTP_SPOOL_MAX_SIZE", str(32 * 1024 * 1024)))
+# Nivel 1 comprime casi igual de rápido que el "fastest" de libdeflate y el
+# endpoint /download está limitado por CPU en deflate, no por ratio.
+ZIP_COMPRESSLEVEL = int(os.getenv("ZIP_COMPRESSLEVEL", "1"))
+# Contexto TLS único para todas las conexiones FTPS: reusar el mismo contexto
+# deja que OpenSSL retome sesiones (handshake abreviado de medio RTT) y fija
+# ciphers AES-GCM, que van por AES-NI. Sin verificación de certificado, igual
+# que el default de ftplib que reemplaza.
+TLS_CONTEXT = ssl.create_default_context()
+TLS_CONTEXT.set_ciphers("ECDHE+AESGCM")
+TLS_CONTEXT.check_hostname = False
+TLS_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# paramiko trae 32 KiB fijos por request SFTP; subir MAX_REQUEST_SIZE reduce
+# round-trips en las lecturas grandes (putfo sigue troceando a 32K internos,
+# pero pipelineados). El servidor debe aceptar paquetes de este tamaño
+# (OpenSSH llega a 256K); si no, bajar SFTP_BLOCK_SIZE a 32768.
+SFTP_BLOCK_SIZE = int(os.getenv("SFTP_BLOCK_SIZE", str(256 * 1024)))
+paramiko.sftp_file.SFTPFile.MAX_REQUEST_SIZE = SFTP_BLOCK_SIZE
+
+
+def _open_transport(host: str, port: int) -> paramiko.Transport:
+    """Abre un Transport sobre un socket con buffers grandes y sin Nagle.
+
+    Los buffers de kernel por defecto (64-256 KiB) estrangulan los acks de la
+    ventana SFTP en enlaces de alta latencia; TCP_NODELAY evita que Nagle
+    retenga los acks de bloques de 32K.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 32 * 1024 * 1024)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024 * 1024)
+    sock.connect((host, port))
+    return paramiko.Transport(sock)
+
+
+class _PooledConnection:
+    """Context manager devuelto por `ConnectionPool.acquire`.
+
+    Entrega el cliente (SFTPClient o FTP_TLS) y lo devuelve al pool al salir.
+    """
+
+    def __init__(self, pool: "ConnectionPool", key: Tuple, password: str):
+        self._pool = pool
+        self._key = key
+        self._password = password
+        self._transport = None
+        self._client = None
+
+    def __enter__(self):
+        self._transport, self._client = self._pool._checkout(self._key, self._password)
+        return self._client
+
+    def __exit__(self, exc_type, exc, tb):
+        self._pool.release(self._key, self._transport, self._client)
+        return False
+
+
+class ConnectionPool:
+    """Pool de conexiones SFTP/FTPS reutilizables, una cola por (host, usuario).
+
+    Evita pagar el handshake SSH/TLS completo en cada request; las conexiones
+    ociosas se guardan en una `LifoQueue` y se verifican con un probe barato
+    antes de reutilizarse. El tamaño se controla con la env var SFTP_POOL_SIZE.
+    """
+
+    def __init__(self, max_size: int = POOL_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pools: Dict[Tuple, queue.LifoQueue] = {}
+
+    def _queue_for(self, key: Tuple) -> queue.LifoQueue:
+        with self._lock:
+            q = self._pools.get(key)
+            if q is None:
+                q = queue.LifoQueue(maxsize=self.max_size)
+                self._pools[key] = q
+            return q
+
+    def _connect(self, key: Tuple, password: str):
+        host, username, port, conn_type = key[:4]
+        if conn_type == "ftps":
+            logger.info("Opening new FTPS connection to %s:%s", host, port)
+            ftps = FTP_TLS(context=TLS_CONTEXT)
+            ftps.connect(host, port, timeout=30)
+            ftps.auth()
+            ftps.login(username, password)
+            ftps.prot_p()
+            # Home capturado una vez: las conexiones del pool conservan su cwd
+            # entre requests, así que todo cwd se resuelve desde acá
+            ftps._home = ftps.pwd()
+            ftps._last_cwd = None
+            return None, ftps
+        logger.info("Opening new SFTP connection to %s:%s", host, port)
+        transport = _open_transport(host, port)
+        transport.connect(username=username, password=password)
+        client = paramiko.SFTPClient.from_transport(transport)
+        return transport, client
+
+    def _checkout(self, key: Tuple, password: str):
+        q = self._queue_for(key)
+        try:
+            transport, client = q.get_nowait()
+            logger.info("Reusing pooled %s connection to %s", key[3], key[0])
+            return transport, client
+        except queue.Empty:
+            return self._connect(key, password)
+
+    def acquire(self, host: str, user: str, pw: str, port: int, conn_type: str = "sftp") -> _PooledConnection:
+        # El digest del password integra la clave: un caller con credenciales
+        # equivocadas no debe pescar una sesión ya autenticada por otro
+        pw_digest = hashlib.sha256((pw or "").encode()).hexdigest()
+        key = (host, user, port, conn_type.lower(), pw_digest)
+        return _PooledConnection(self, key, pw)
+
+    def release(self, key: Tuple, transport, client) -> None:
+        conn_type = key[3]
+        try:
+            # Probe barato de vida antes de devolver al pool
+            if conn_type == "ftps":
+                client.voidcmd("NOOP")
+            else:
+                client.listdir(".")
+        except Exception:
+            logger.info("Dropping dead %s connection to %s", conn_type, key[0])
+            self._close(transport, client, conn_type)
+            return
+        try:
+            self._queue_for(key).put_nowait((transport, client))
+        except queue.Full:
+            self._close(transport, client, conn_type)
+
+    @staticmethod
+    def _close(transport, client, conn_type: str) -> None:
+        try:
+            if conn_type == "ftps":
+                client.quit()
+            else:
+                client.close()
+                transport.close()
+        except Exception:
+            pass
+
+
+# Pool compartido a nivel de módulo
+pool = ConnectionPool()
+
+def _ftps_cwd(ftps, target: str) -> None:
+    """cwd cacheado para conexiones FTPS reutilizadas.
+
+    El cwd de una conexión del pool sobrevive al request que la usó, de modo
+    que los destinos relativos se resuelven siempre volviendo primero al home
+    capturado al conectar. Si la conexión ya está parada en `target`, no viaja
+    ningún comando.
+    """
+    if getattr(ftps, "_last_cwd", None) == target:
+        return
+    ftps._last_cwd = None
+    ftps.cwd(ftps._home)
+    if target and target != ".":
+        ftps.cwd(target)
+    ftps._last_cwd = target
+
+
+_MLSD_MODIFY_RE = re.compile(r"(?:^|;)modify=(\d{14})", re.IGNORECASE)
+_MLSD_TYPE_RE = re.compile(r"(?:^|;)type=([^;]+)", re.IGNORECASE)
+
+
+def _list_ftps_entries(ftps):
+    """Lista (nombre, mtime) del cwd con un solo MLSD.
+
+    Devuelve None si el servidor no soporta MLSD (respuesta 5xx), para que el
+    caller caiga al viejo camino nlst + MDTM por archivo. Un solo round-trip
+    reemplaza len(archivos) RTTs secuenciales en el filtro por fecha.
+    """
+    lines = []
+    try:
+        ftps.retrlines("MLSD", lines.append)
+    except error_perm:
+        return None
+
+    entries = []
+    for line in lines:
+        facts, _, name = line.partition(" ")
+        if not name:
+            continue
+        tipo = _MLSD_TYPE_RE.search(facts)
+        if tipo and tipo.group(1).lower() in ("dir", "cdir", "pdir"):
+            continue
+        modify = _MLSD_MODIFY_RE.search(facts)
+        mtime = datetime.strptime(modify.group(1), "%Y%m%d%H%M%S") if modify else None
+        entries.append((name, mtime))
+    return entries
+
+
+def _select_files(archivos, filename_startswith, from_date, get_mod_time) -> List[str]:
+    # Filtrar archivos
+    logger.info("Filtering files (startswith: %s, from_date: %s)", filename_startswith, from_date)
+    seleccionados = []
+    prefixes = tuple(filename_startswith)
+    from_dt = datetime.fromisoformat(from_date) if from_date else None
+    for archivo in archivos:
+        if prefixes and not archivo.startswith(prefixes):
+            continue
+        if from_dt is not None and get_mod_time(archivo) < from_dt:
+            continue
+        seleccionados.append(archivo)
+
+    logger.info("Selected %d files to download", len(seleccionados))
+
+    if not seleccionados:
+        logger.warning("No files found matching criteria")
+        raise Exception("No se encontraron archivos con los criterios dados")
+
+    return seleccionados
+
+
+def _download_parallel(seleccionados, download_one, zipf) -> None:
+    """Descarga los archivos en paralelo y los vuelca al ZIP según completan.
+
+    paramiko no es thread-safe sobre un mismo canal, así que cada worker
+    adquiere su propio cliente; la concurrencia multiplica el ancho de banda
+    efectivo en transferencias limitadas por latencia. ZipFile tampoco admite
+    escrituras concurrentes, de modo que los workers entregan un spool
+    (memoria o tmp) y el hilo principal lo copia al ZIP a medida que los
+    futures terminan — cada archivo se lee del servidor una sola vez.
+    """
+    workers = min(MAX_WORKERS, len(seleccionados))
+    logger.info("Starting file downloads with %d workers", workers)
+    futures = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = {ex.submit(download_one, archivo): archivo for archivo in seleccionados}
+            for i, fut in enumerate(as_completed(futures), 1):
+                archivo = futures[fut]
+                with fut.result() as spool:
+                    spool.seek(0)
+                    zinfo = zipfile.ZipInfo(archivo, date_time=datetime.now().timetuple()[:6])
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    zinfo._compresslevel = ZIP_COMPRESSLEVEL
+                    with zipf.open(zinfo, "w", force_zip64=True) as dst:
+                        shutil.copyfileobj(spool, dst, length=1 << 20)
+                logger.info("Downloaded file %d/%d: %s", i, len(seleccionados), archivo)
+    except BaseException:
+        # Una descarga falló: al salir del executor los demás futures ya
+        # terminaron; cerrar los spools que nadie va a consumir
+        for fut in futures:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                try:
+                    fut.result().close()
+                except Exception:
+                    pass
+        raise
+
+
+def download_from_server(host: str, username: str, password: str, directory: str,
+                         download_path: str, filename_startswith: List[str] = None,
+                         from_date: str = "", port: int = None, conn_type: str = "sftp",
+                         save_local: bool = True) -> BinaryIO:
+    filename_startswith = filename_startswith or []
+    # En un servicio de larga vida el directorio casi siempre existe ya;
+    # un isdir ahorra el makedirs completo por request
+    if save_local and not os.path.isdir(download_path):
+        os.makedirs(download_path, exist_ok=True)
+
+    logger.info("Starting download from %s (type: %s)", host, conn_type)
+
+    # Prefijo remoto precalculado: evita re-normalizar el join por archivo
+    # en cada uno de los callbacks calientes
+    remote_prefix = (directory.rstrip("/") + "/") if directory else ""
+
+    def _spool_for(f):
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        local = None
+        if save_local:
+            # fd crudo + buffer de 1 MiB: agrupa los bloques de 32K de paramiko
+            # en pocas escrituras grandes al kernel
+            fd = os.open(os.path.join(download_path, f),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            local = os.fdopen(fd, "wb", buffering=1 << 20)
+        return spool, local
+
+    def _discard_partial(f, spool, local):
+        # Transferencia fallida: liberar spool/fd y no dejar un archivo
+        # local truncado atrás
+        spool.close()
+        if local:
+            local.close()
+            try:
+                os.remove(os.path.join(download_path, f))
+            except OSError:
+                pass
+
+    if conn_type.lower() == "ftps":
+        port = port or 990
+        with pool.acquire(host, username, password, port, "ftps") as ftps:
+            _ftps_cwd(ftps, directory)
+            logger.info("Connected to FTPS, listing directory %s", directory)
+
+            def mdtm_mod_time(f):
+                mdtm = ftps.sendcmd(f"MDTM {f}")
+                return datetime.strptime(mdtm[4:], "%Y%m%d%H%M%S")
+
+            entries = _list_ftps_entries(ftps)
+            if entries is not None:
+                archivos = [name for name, _ in entries]
+                mtimes = dict(entries)
+
+                def get_mod_time(f):
+                    # MLSD ya trajo el mtime; MDTM solo si faltó el fact
+                    return mtimes.get(f) or mdtm_mod_time(f)
+            else:
+                logger.info("Server does not support MLSD, falling back to MDTM per file")
+                archivos = ftps.nlst()
+                get_mod_time = mdtm_mod_time
+
+            logger.info("Found %d files in directory", len(archivos))
+            seleccionados = _select_files(archivos, filename_startswith, from_date, get_mod_time)
+
+        def download_one(f):
+            spool, local = _spool_for(f)
+
+            def _write(chunk):
+                spool.write(chunk)
+                if local:
+                    local.write(chunk)
+
+            try:
+                with pool.acquire(host, username, password, port, "ftps") as conn:
+                    # La conexión puede venir con cualquier cwd heredado;
+                    # pararse en el directorio y pedir el nombre pelado
+                    _ftps_cwd(conn, directory)
+                    conn.retrbinary(f"RETR {f}", _write, blocksize=1 << 20)
+            except BaseException:
+                _discard_partial(f, spool, local)
+                raise
+            if local:
+                local.close()
+            return spool
+
+    elif conn_type.lower() == "sftp":
+        port = port or 22
+        with pool.acquire(host, username, password, port, "sftp") as client:
+            archivos = client.listdir(directory)
+            logger.info("Connected to SFTP, found %d files in directory", len(archivos))
+
+            def get_mod_time(f):
+                attr = client.stat(remote_prefix + f)
+                return datetime.fromtimestamp(attr.st_mtime)
+
+            seleccionados = _select_files(archivos, filename_startswith, from_date, get_mod_time)
+
+        def download_one(f):
+            spool, local = _spool_for(f)
+            try:
+                with pool.acquire(host, username, password, port, "sftp") as conn:
+                    with conn.open(remote_prefix + f, "rb") as src:
+                        try:
+                            src.prefetch(src.stat().st_size, PREFETCH_WINDOW)
+                        except Exception:
+                            # prefetch es solo una optimización; seguimos sin él
+                            pass
+                        while True:
+                            chunk = src.read(1 << 20)
+                            if not chunk:
+                                break
+                            spool.write(chunk)
+                            if local:
+                                local.write(chunk)
+            except BaseException:
+                _discard_partial(f, spool, local)
+                raise
+            if local:
+                local.close()
+            return spool
+
+    else:
+        raise ValueError("conn_type debe ser 'sftp' o 'ftps'")
+
+    # Crear ZIP alimentado directamente por las descargas; los archivos
+    # grandes se derraman a disco temporal en vez de retener todo en RAM
+    logger.info("Creating ZIP archive while downloading")
+    zip_buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=ZIP_COMPRESSLEVEL) as zipf:
+        _download_parallel(seleccionados, download_one, zipf)
+
+    zip_buffer.seek(0)
+    logger.info("Download complete, returning ZIP archive")
+    return zip_buffer
+
+
+def upload_to_server(host: str, username: str, password: str, remote_directory: str,
+                     files: List[Tuple[str, BinaryIO]], port: int = None, conn_type: str = "sftp") -> List[str]:
+    """Upload a list of (relative_path, file_object) to the remote server under `remote_directory`.
+
+    The file objects are streamed as-is, never materialized in memory.
+
+    Returns list of remote paths uploaded.
+    """
+    # Ensure remote_directory is posix-style
+    remote_base = remote_directory or "."
+
+    if conn_type.lower() == "ftps":
+        port = port or 990
+        return _upload_ftps(host, username, password, port, remote_base, files)
+
+    elif conn_type.lower() == "sftp":
+        port = port or 22
+        return _upload_sftp(host, username, password, port, remote_base, files)
+
+    else:
+        raise ValueError("conn_type must be 'sftp' or 'ftps'")
+
+
+def _normalize_relpath(relpath: str) -> str:
+    relposix = posixpath.normpath(relpath).lstrip("/")
+    if relposix in ("", ".") or relposix.startswith(".."):
+        return ""
+    return relposix
+
+
+def _prepare_uploads(files: List[Tuple[str, BinaryIO]], base_prefix: str):
+    """Normaliza las rutas del lote en una sola pasada.
+
+    Devuelve tuplas (remote_path, remote_dir, basename, fileobj) ordenadas por
+    directorio, de modo que el loop de subida no hace trabajo de strings y los
+    archivos de una misma carpeta quedan consecutivos para los memos/cwd.
+    """
+    prepared = []
+    for relpath, fileobj in files:
+        relposix = _normalize_relpath(relpath)
+        if not relposix:
+            continue
+        remote_path = base_prefix + relposix
+        prepared.append((remote_path, posixpath.dirname(remote_path),
+                         posixpath.basename(remote_path), fileobj))
+    prepared.sort(key=lambda item: item[1])
+    return prepared
+
+
+def _upload_ftps(host: str, username: str, password: str, port: int,
+                 remote_base: str, files: List[Tuple[str, BinaryIO]]) -> List[str]:
+    # Prefijo base precalculado para no re-normalizar el join por archivo
+    base_prefix = remote_base.rstrip("/") + "/" if remote_base != "/" else "/"
+    prepared = _prepare_uploads(files, base_prefix)
+    if not prepared:
+        return []
+
+    # Directorios ya creados, compartido entre workers
+    ensured_dirs = set()
+    ensured_lock = threading.Lock()
+
+    # Helper to create nested dirs on FTPS
+    def ensure_dir(ftps, path: str):
+        # La caminata deja el cwd en estados intermedios: invalidar el cache
+        # y arrancar siempre desde el home para que `path` resuelva igual en
+        # cualquier conexión del pool
+        ftps._last_cwd = None
+        ftps.cwd(ftps._home)
+        parts = [p for p in path.split("/") if p]
+        for p in parts:
+            try:
+                ftps.cwd(p)
+            except Exception:
+                try:
+                    ftps.mkd(p)
+                except Exception:
+                    # Otro worker pudo crearlo en paralelo (550 ya existe);
+                    # el cwd de abajo decide si el directorio falta de verdad
+                    pass
+                ftps.cwd(p)
+        # la conexión queda parada en `path`; dejar el cache consistente
+        ftps._last_cwd = path
+
+    def upload_one(remote_path: str, remote_dir: str, name: str, fileobj: BinaryIO):
+        with pool.acquire(host, username, password, port, "ftps") as ftps:
+            # Ensure remote_dir exists (once per directory across workers)
+            if remote_dir and remote_dir != ".":
+                with ensured_lock:
+                    seen = remote_dir in ensured_dirs
+                if not seen:
+                    ensure_dir(ftps, remote_dir)
+                    with ensured_lock:
+                        ensured_dirs.add(remote_dir)
+
+            # Navigate to remote_dir then storbinary with filename; si la
+            # conexión ya está parada en ese directorio, ahorrar el cwd
+            target = remote_dir or remote_base
+            try:
+                _ftps_cwd(ftps, target)
+            except Exception:
+                # ensure and retry
+                ensure_dir(ftps, target)
+
+            if fileobj.seekable():
+                fileobj.seek(0)
+            ftps.storbinary(f"STOR {name}", fileobj, blocksize=1 << 20)
+
+        # Liberar el stream (miembro ZIP o spool) apenas termina su subida
+        fileobj.close()
+        return remote_path
+
+    workers = min(MAX_WORKERS, len(prepared))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(upload_one, *item) for item in prepared]
+        # Recoger en orden de envío para mantener estable la lista devuelta
+        return [fut.result() for fut in futures]
+
+
+def _upload_sftp(host: str, username: str, password: str, port: int,
+                 remote_base: str, files: List[Tuple[str, BinaryIO]]) -> List[str]:
+    # Prefijo base precalculado para no re-normalizar el join por archivo
+    base_prefix = remote_base.rstrip("/") + "/" if remote_base != "/" else "/"
+    prepared = _prepare_uploads(files, base_prefix)
+    if not prepared:
+        return []
+
+    # Directorios ya creados, compartido entre workers
+    ensured_dirs = set()
+    ensured_lock = threading.Lock()
+
+    # ensure remote directory exists (posix); cada componente ya verificado
+    # se memoiza para no repetir el stat (un RTT) por cada archivo del lote
+    def ensure_remote_dirs(client, path: str):
+        parts = [p for p in path.split("/") if p]
+        cur = ""
+        for p in parts:
+            cur = posixpath.join(cur, p) if cur else p
+            with ensured_lock:
+                if cur in ensured_dirs:
+                    continue
+            try:
+                client.stat(cur)
+            except IOError:
+                try:
+                    client.mkdir(cur)
+                except Exception:
+                    # Could be created concurrently; ignore
+                    pass
+            with ensured_lock:
+                ensured_dirs.add(cur)
+
+    def upload_one(remote_path: str, remote_dir: str, name: str, fileobj: BinaryIO):
+        with pool.acquire(host, username, password, port, "sftp") as client:
+            if remote_dir and remote_dir != ".":
+                with ensured_lock:
+                    seen = remote_dir in ensured_dirs
+                if not seen:
+                    ensure_remote_dirs(client, remote_dir)
+                    with ensured_lock:
+                        ensured_dirs.add(remote_dir)
+
+            # putfo pipelinea las escrituras (varios WRITE en vuelo) y con
+            # confirm=False se ahorra el stat() de verificación posterior
+            if fileobj.seekable():
+                fileobj.seek(0)
+            client.putfo(fileobj, remote_path, confirm=False)
+
+        # Liberar el stream (miembro ZIP o spool) apenas termina su subida
+        fileobj.close()
+        return remote_path
+
+    workers = min(MAX_WORKERS, len(prepared))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(upload_one, *item) for item in prepared]
+        # Recoger en orden de envío para mantener estable la lista devuelta
+        return [fut.result() for fut in futures]
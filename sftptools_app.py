@@ -1,231 +1,403 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from services.sftp_service import download_from_server, upload_to_server
-from fastapi.responses import Response
-from typing import List, Optional
-import os
-from dotenv import load_dotenv
-from fastapi import UploadFile, File, Form
-from fastapi.responses import JSONResponse
-import zipfile
-from io import BytesIO
-import smtplib
-from email.message import EmailMessage
-import ssl
-import mimetypes
-import base64
-
-load_dotenv()  # carga variables del .env
-
-BASE_DOWNLOAD_PATH = os.getenv("BASE_DOWNLOAD_PATH", "C:/Users/adminlambare/agilsftp")
-
-app = FastAPI(title="SFTP/FTPS Tools API")
-
-class ServerRequest(BaseModel):
-    host: str
-    directory: str
-    destination_folder: str
-    username: str
-    password: str
-    filename_startswith: Optional[List[str]] = None
-    from_date: Optional[str] = ""
-    port: Optional[int] = None
-    conn_type: Optional[str] = "sftp"
-
-class SMTPConfig(BaseModel):
-    host: str
-    port: int
-    user: str
-    password: str
-    use_tls: bool
-
-class Attachment(BaseModel):
-    filename: str
-    content: str  # base64 encoded
-
-class MailData(BaseModel):
-    sender: str
-    sender_name: Optional[str] = None
-    recipient: str
-    subject: str
-    body: str
-    html: bool = False
-    attachments: Optional[List[Attachment]] = None
-
-class SendMailRequest(BaseModel):
-    smtp: SMTPConfig
-    mail: MailData
-
-@app.post("/download")
-async def server_copy(request: ServerRequest):
-    try:
-        download_path = os.path.join(BASE_DOWNLOAD_PATH, os.path.basename(request.destination_folder))
-        os.makedirs(download_path, exist_ok=True)
-
-        zip_buffer = download_from_server(
-            host=request.host,
-            username=request.username,
-            password=request.password,
-            directory=request.directory,
-            download_path=download_path,
-            filename_startswith=request.filename_startswith or [],
-            from_date=request.from_date,
-            port=request.port,
-            conn_type=request.conn_type
-        )
-
-        headers = {"Content-Disposition": f"attachment; filename={request.destination_folder}_archivos.zip"}
-        zip_buffer.seek(0)
-        return Response(content=zip_buffer.read(), media_type="application/zip", headers=headers)
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-
-@app.post("/upload")
-async def upload_files(
-    host: str = Form(...),
-    username: str = Form(...),
-    password: str = Form(...),
-    remote_directory: str = Form(...),
-    conn_type: Optional[str] = Form("sftp"),
-    port: Optional[int] = Form(None),
-    extract_zip: Optional[bool] = Form(False),
-    files: List[UploadFile] = File(...),
-):
-    """Receive one or more files and forward them to the remote SFTP/FTPS server.
-
-    Form fields:
-    - `host`, `username`, `password`, `remote_directory`, `conn_type` (sftp|ftps), `port`, `extract_zip`
-    - `files`: one or more file parts. If `extract_zip` is true and a single zip is provided, its contents are uploaded preserving paths.
-    """
-    try:
-        to_upload = []  # List[Tuple[relative_path, bytes]]
-
-        # If user uploaded one ZIP and requested extraction, extract in-memory
-        if extract_zip and len(files) == 1 and files[0].filename.lower().endswith(".zip"):
-            content = await files[0].read()
-            with zipfile.ZipFile(BytesIO(content)) as z:
-                for member in z.namelist():
-                    # Normalize and prevent traversal
-                    norm = os.path.normpath(member).lstrip("\\/")
-                    if norm == "" or norm.startswith(".."):
-                        continue
-                    if member.endswith("/"):
-                        continue
-                    data = z.read(member)
-                    to_upload.append((norm.replace("\\", "/"), data))
-        else:
-            for upload in files:
-                filename = upload.filename or "uploaded_file"
-                norm = os.path.normpath(filename)
-                if os.path.isabs(norm) or norm.startswith(".."):
-                    raise HTTPException(status_code=400, detail=f"Invalid filename in upload: {filename}")
-                data = await upload.read()
-                # use posix-style paths for remote
-                rel = norm.replace("\\", "/")
-                to_upload.append((rel, data))
-
-        # Call service to upload to remote server
-        uploaded = upload_to_server(
-            host=host,
-            username=username,
-            password=password,
-            remote_directory=remote_directory,
-            files=to_upload,
-            port=port,
-            conn_type=conn_type,
-        )
-
-        return JSONResponse(content={"uploaded": uploaded})
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-
-@app.post("/send-email")
-def send_email(data: SendMailRequest):
-    try:
-        msg = EmailMessage()
-        # Construir el header From con nombre si se proporciona
-        if data.mail.sender_name:
-            msg["From"] = f"{data.mail.sender_name} <{data.mail.sender}>"
-        else:
-            msg["From"] = data.mail.sender
-        msg["To"] = data.mail.recipient
-        msg["Subject"] = data.mail.subject
-
-        if data.mail.html:
-            msg.add_alternative(data.mail.body, subtype="html")
-        else:
-            msg.set_content(data.mail.body)
-
-        # Procesar y adjuntar archivos si existen
-        if data.mail.attachments:
-            for attachment in data.mail.attachments:
-                try:
-                    # Decodificar base64 con corrección de padding
-                    content = attachment.content
-                    # Agregar padding si es necesario (base64 debe ser múltiplo de 4)
-                    missing_padding = len(content) % 4
-                    if missing_padding:
-                        content += '=' * (4 - missing_padding)
-                    
-                    file_data = base64.b64decode(content)
-                    
-                    # Identificar tipo MIME basado en la extensión del archivo
-                    mime_type, _ = mimetypes.guess_type(attachment.filename)
-                    if mime_type is None:
-                        mime_type = "application/octet-stream"
-                    
-                    # Separar tipo y subtipo (ej: "image/png" -> "image", "png")
-                    maintype, subtype = mime_type.split("/", 1)
-                    
-                    # Adjuntar archivo
-                    msg.add_attachment(
-                        file_data,
-                        maintype=maintype,
-                        subtype=subtype,
-                        filename=attachment.filename
-                    )
-                except Exception as e:
-                    raise HTTPException(status_code=400, detail=f"Error procesando archivo {attachment.filename}: {str(e)}")
-
-        context = ssl.create_default_context()
-        # Desactivar verificación de certificado para IPs sin coincidencia de dominio
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-
-        # Puerto 465: SMTPS (SSL desde el inicio)
-        # Puerto 587: SMTP + STARTTLS
-        if data.smtp.port == 465:
-            with smtplib.SMTP_SSL(data.smtp.host, data.smtp.port, context=context) as server:
-                server.login(data.smtp.user, data.smtp.password)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(data.smtp.host, data.smtp.port) as server:
-                if data.smtp.use_tls:
-                    server.starttls(context=context)
-
-                server.login(data.smtp.user, data.smtp.password)
-                server.send_message(msg)
-
-        return {"success": True}
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-
-try:
-    from services import ftp_rest as _ftp_rest
-    # Include the router so routes appear in the main app's docs under the prefix /ftp
-    if hasattr(_ftp_rest, "router"):
-        app.include_router(_ftp_rest.router, prefix="/ftp")
-    else:
-        # fallback to mount the sub-app if router not present
-        app.mount("/ftp", _ftp_rest.app)
-except Exception:
-    # If import fails, keep the original app functional; import errors will surface at runtime.
-    pass
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+from services.sftp_service import download_from_server, upload_to_server
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+import asyncio
+import os
+from dotenv import load_dotenv
+from fastapi import UploadFile, File, Form
+from fastapi.responses import JSONResponse
+import zipfile
+import smtplib
+import hashlib
+import queue
+import threading
+from email.message import EmailMessage
+import ssl
+import mimetypes
+
+try:
+    # pybase64 procesa base64 con SIMD (AVX2/SSSE3), mismo API que la stdlib
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+load_dotenv()  # carga variables del .env
+
+BASE_DOWNLOAD_PATH = os.getenv("BASE_DOWNLOAD_PATH", "C:/Users/adminlambare/agilsftp")
+
+app = FastAPI(title="SFTP/FTPS Tools API")
+
+# Contexto TLS compartido para SMTP: un solo contexto entre requests permite a
+# OpenSSL reusar session tickets (handshake abreviado) y fija ciphers AES-GCM.
+# Verificación desactivada para IPs sin coincidencia de dominio, como antes.
+SMTP_TLS_CONTEXT = ssl.create_default_context()
+SMTP_TLS_CONTEXT.set_ciphers("ECDHE+AESGCM")
+SMTP_TLS_CONTEXT.check_hostname = False
+SMTP_TLS_CONTEXT.verify_mode = ssl.CERT_NONE
+
+class ServerRequest(BaseModel):
+    host: str
+    directory: str
+    destination_folder: str
+    username: str
+    password: str
+    filename_startswith: Optional[List[str]] = None
+    from_date: Optional[str] = ""
+    port: Optional[int] = None
+    conn_type: Optional[str] = "sftp"
+
+class SMTPConfig(BaseModel):
+    host: str
+    port: int
+    user: str
+    password: str
+    use_tls: bool
+
+class Attachment(BaseModel):
+    filename: str
+    content: str  # base64 encoded
+
+class MailData(BaseModel):
+    sender: str
+    sender_name: Optional[str] = None
+    recipient: str
+    subject: str
+    body: str
+    html: bool = False
+    attachments: Optional[List[Attachment]] = None
+
+class SendMailRequest(BaseModel):
+    smtp: SMTPConfig
+    mail: MailData
+
+@app.post("/download")
+async def server_copy(request: ServerRequest):
+    try:
+        download_path = os.path.join(BASE_DOWNLOAD_PATH, os.path.basename(request.destination_folder))
+
+        # paramiko/ftplib son bloqueantes: correr la transferencia en un
+        # thread para no clavar el event loop mientras dura
+        zip_buffer = await asyncio.to_thread(
+            download_from_server,
+            host=request.host,
+            username=request.username,
+            password=request.password,
+            directory=request.directory,
+            download_path=download_path,
+            filename_startswith=request.filename_startswith or [],
+            from_date=request.from_date,
+            port=request.port,
+            conn_type=request.conn_type,
+            save_local=False
+        )
+
+        headers = {"Content-Disposition": f"attachment; filename={request.destination_folder}_archivos.zip"}
+        zip_buffer.seek(0)
+
+        # Emitir el ZIP en chunks: evita cargar todo el archivo en RAM y
+        # bloquear el event loop con un read() gigante
+        def _iter_zip():
+            try:
+                while True:
+                    chunk = zip_buffer.read(1 << 20)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                zip_buffer.close()
+
+        return StreamingResponse(_iter_zip(), media_type="application/zip", headers=headers)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/upload")
+async def upload_files(
+    host: str = Form(...),
+    username: str = Form(...),
+    password: str = Form(...),
+    remote_directory: str = Form(...),
+    conn_type: Optional[str] = Form("sftp"),
+    port: Optional[int] = Form(None),
+    extract_zip: Optional[bool] = Form(False),
+    files: List[UploadFile] = File(...),
+):
+    """Receive one or more files and forward them to the remote SFTP/FTPS server.
+
+    Form fields:
+    - `host`, `username`, `password`, `remote_directory`, `conn_type` (sftp|ftps), `port`, `extract_zip`
+    - `files`: one or more file parts. If `extract_zip` is true and a single zip is provided, its contents are uploaded preserving paths.
+    """
+    try:
+        to_upload = []  # List[Tuple[relative_path, file_object]]
+
+        async def _do_upload():
+            # upload_to_server es bloqueante; despacharlo a un thread deja
+            # libre el event loop para otras requests
+            return await asyncio.to_thread(
+                upload_to_server,
+                host=host,
+                username=username,
+                password=password,
+                remote_directory=remote_directory,
+                files=to_upload,
+                port=port,
+                conn_type=conn_type,
+            )
+
+        # If user uploaded one ZIP and requested extraction, stream its members
+        if extract_zip and len(files) == 1 and files[0].filename.lower().endswith(".zip"):
+            src = files[0].file  # SpooledTemporaryFile, ya en disco/memoria
+            src.seek(0)
+            with zipfile.ZipFile(src) as z:
+                for member in z.namelist():
+                    # Normalize and prevent traversal
+                    norm = os.path.normpath(member).lstrip("\\/")
+                    if norm == "" or norm.startswith(".."):
+                        continue
+                    if member.endswith("/"):
+                        continue
+                    # z.open entrega un stream descomprimido bajo demanda,
+                    # sin materializar el miembro completo
+                    to_upload.append((norm.replace("\\", "/"), z.open(member)))
+                # Upload while the ZIP is still open so member streams stay valid
+                uploaded = await _do_upload()
+        else:
+            for upload in files:
+                filename = upload.filename or "uploaded_file"
+                norm = os.path.normpath(filename)
+                if os.path.isabs(norm) or norm.startswith(".."):
+                    raise HTTPException(status_code=400, detail=f"Invalid filename in upload: {filename}")
+                # use posix-style paths for remote; pass the spooled file
+                # object through instead of reading it into RAM
+                rel = norm.replace("\\", "/")
+                upload.file.seek(0)
+                to_upload.append((rel, upload.file))
+            uploaded = await _do_upload()
+
+        return JSONResponse(content={"uploaded": uploaded})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+# Rotar la conexión después de N envíos para respetar límites de burst
+# por conexión de los relays típicos.
+SMTP_MAX_SENDS_PER_CONN = int(os.getenv("SMTP_MAX_SENDS_PER_CONN", "100"))
+
+
+class _PooledSMTP:
+    """Context manager que entrega un smtplib.SMTP del pool y lo devuelve."""
+
+    def __init__(self, pool: "SMTPPool", cfg: SMTPConfig):
+        self._pool = pool
+        self._cfg = cfg
+        self._server = None
+
+    def __enter__(self):
+        self._server = self._pool._checkout(self._cfg)
+        return self._server
+
+    def __exit__(self, exc_type, exc, tb):
+        # Si el envío falló, no devolver la conexión: mejor descartarla
+        self._pool.release(self._cfg, self._server, healthy=exc_type is None)
+        return False
+
+
+class SMTPPool:
+    """Pool de conexiones SMTP autenticadas.
+
+    TLS + AUTH cuestan varios round-trips por envío; reutilizar la sesión los
+    paga una sola vez por ráfaga. Las conexiones se verifican con NOOP al
+    sacarlas y se rotan tras SMTP_MAX_SENDS_PER_CONN envíos.
+    """
+
+    def __init__(self, max_size: int = SMTP_POOL_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    @staticmethod
+    def _key(cfg: SMTPConfig):
+        # El digest del password y use_tls integran la clave: credenciales
+        # equivocadas o un pedido TLS no deben reutilizar una sesión ajena
+        pw_digest = hashlib.sha256((cfg.password or "").encode()).hexdigest()
+        return (cfg.host, cfg.port, cfg.user, cfg.use_tls, pw_digest)
+
+    def _queue_for(self, key):
+        with self._lock:
+            q = self._pools.get(key)
+            if q is None:
+                q = queue.LifoQueue(maxsize=self.max_size)
+                self._pools[key] = q
+            return q
+
+    def _connect(self, cfg: SMTPConfig):
+        # Puerto 465: SMTPS (SSL desde el inicio)
+        # Puerto 587: SMTP + STARTTLS
+        if cfg.port == 465:
+            server = smtplib.SMTP_SSL(cfg.host, cfg.port, context=SMTP_TLS_CONTEXT)
+        else:
+            server = smtplib.SMTP(cfg.host, cfg.port)
+            if cfg.use_tls:
+                server.starttls(context=SMTP_TLS_CONTEXT)
+        server.login(cfg.user, cfg.password)
+        server._send_count = 0
+        return server
+
+    def _checkout(self, cfg: SMTPConfig):
+        q = self._queue_for(self._key(cfg))
+        while True:
+            try:
+                server = q.get_nowait()
+            except queue.Empty:
+                return self._connect(cfg)
+            try:
+                server.noop()
+                return server
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPException, OSError):
+                self._discard(server)
+
+    def acquire(self, cfg: SMTPConfig) -> _PooledSMTP:
+        return _PooledSMTP(self, cfg)
+
+    def release(self, cfg: SMTPConfig, server, healthy: bool = True) -> None:
+        if server is None:
+            return
+        server._send_count += 1
+        if not healthy or server._send_count >= SMTP_MAX_SENDS_PER_CONN:
+            self._discard(server)
+            return
+        try:
+            self._queue_for(self._key(cfg)).put_nowait(server)
+        except queue.Full:
+            self._discard(server)
+
+    @staticmethod
+    def _discard(server) -> None:
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+
+# Pool compartido a nivel de módulo
+smtp_pool = SMTPPool()
+
+
+# Cache de mensajes MIME ya construidos: para el patrón "misma plantilla,
+# distinto destinatario" el encode base64/quoted-printable de los adjuntos
+# se paga una sola vez. Acotado para no retener adjuntos viejos sin límite.
+_mail_cache = {}
+_mail_cache_lock = threading.Lock()
+_MAIL_CACHE_MAX = 128
+
+
+def build_message(mail: MailData) -> bytes:
+    """Construye el MIME del mail (sin el header To) y cachea los bytes.
+
+    La clave es un hash de remitente, asunto, cuerpo y adjuntos; mails
+    idénticos a distintos destinatarios reutilizan los mismos bytes.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((mail.sender, mail.sender_name, mail.subject,
+                        mail.html, mail.body)).encode())
+    for attachment in mail.attachments or []:
+        hasher.update(attachment.filename.encode())
+        hasher.update(attachment.content.encode())
+    key = hasher.digest()
+
+    with _mail_cache_lock:
+        cached = _mail_cache.get(key)
+    if cached is not None:
+        return cached
+
+    msg = EmailMessage()
+    # Construir el header From con nombre si se proporciona
+    if mail.sender_name:
+        msg["From"] = f"{mail.sender_name} <{mail.sender}>"
+    else:
+        msg["From"] = mail.sender
+    msg["Subject"] = mail.subject
+
+    if mail.html:
+        msg.add_alternative(mail.body, subtype="html")
+    else:
+        msg.set_content(mail.body)
+
+    # Procesar y adjuntar archivos si existen
+    if mail.attachments:
+        for attachment in mail.attachments:
+            try:
+                # Decodificar base64 con corrección de padding
+                content = attachment.content
+                # Agregar padding si es necesario (base64 debe ser múltiplo de 4)
+                missing_padding = len(content) % 4
+                if missing_padding:
+                    content += '=' * (4 - missing_padding)
+
+                file_data = base64.b64decode(content)
+
+                # Identificar tipo MIME basado en la extensión del archivo
+                mime_type, _ = mimetypes.guess_type(attachment.filename)
+                if mime_type is None:
+                    mime_type = "application/octet-stream"
+
+                # Separar tipo y subtipo (ej: "image/png" -> "image", "png")
+                maintype, subtype = mime_type.split("/", 1)
+
+                # Adjuntar archivo
+                msg.add_attachment(
+                    file_data,
+                    maintype=maintype,
+                    subtype=subtype,
+                    filename=attachment.filename
+                )
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Error procesando archivo {attachment.filename}: {str(e)}")
+
+    raw = msg.as_bytes()
+    with _mail_cache_lock:
+        if len(_mail_cache) >= _MAIL_CACHE_MAX:
+            _mail_cache.clear()
+        _mail_cache[key] = raw
+    return raw
+
+
+@app.post("/send-email")
+def send_email(data: SendMailRequest):
+    # Al concatenar el To a mano, un CR/LF en el destinatario inyectaría
+    # headers arbitrarios (y comandos SMTP via sendmail); rechazarlo antes
+    if "\r" in data.mail.recipient or "\n" in data.mail.recipient:
+        raise HTTPException(status_code=400, detail="Invalid recipient address")
+    try:
+        # El To va por fuera del cache; sendmail evita además el re-parseo de
+        # headers que hace send_message
+        raw = b"To: " + data.mail.recipient.encode() + b"\r\n" + build_message(data.mail)
+
+        with smtp_pool.acquire(data.smtp) as server:
+            server.sendmail(data.mail.sender, [data.mail.recipient], raw)
+
+        return {"success": True}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+try:
+    from services import ftp_rest as _ftp_rest
+    # Include the router so routes appear in the main app's docs under the prefix /ftp
+    if hasattr(_ftp_rest, "router"):
+        app.include_router(_ftp_rest.router, prefix="/ftp")
+    else:
+        # fallback to mount the sub-app if router not present
+        app.mount("/ftp", _ftp_rest.app)
+except Exception:
+    # If import fails, keep the original app functional; import errors will surface at runtime.
+    pass